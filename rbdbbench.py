@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import mmap
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+
+from rbdbutil import RBDB, LastFM, strstd, join_counts
+from rbdbgen import generate_rbdb, generate_lastfm
+
+def timed(fn, repeat=1):
+    # best of repeat runs, in seconds
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+def peak_memory(fn):
+    # peak traced allocation while running fn, in MiB
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1] / (1 << 20)
+    finally:
+        tracemalloc.stop()
+
+def report(tracks, name, seconds, count=None, unit="entries", peak=None):
+    rate = f"{count / seconds:12,.0f} {unit}/s" if count else ""
+    memory = f" peak {peak:8.1f} MiB" if peak is not None else ""
+    print(f"{tracks:>9,} {name:<22} {seconds:9.4f}s {rate}{memory}")
+
+def bench_rbdb(root, tracks, repeat):
+    report(tracks, "RBDB.__init__", timed(lambda: RBDB(root), repeat))
+
+    rbdb = RBDB(root)
+    report(tracks, "iter_entries", timed(lambda: sum(1 for _ in rbdb.iter_entries()), repeat), tracks)
+    report(tracks, "iter_entries numeric",
+           timed(lambda: sum(1 for _ in rbdb.iter_entries(("PLAYCOUNT", "PLAYTIME", "LEN"))), repeat), tracks)
+
+    def next_entry_loop():
+        rbdb.cur_offset = 24
+        while not rbdb.EOF():
+            rbdb.next_entry()
+
+    report(tracks, "next_entry loop", timed(next_entry_loop, repeat), tracks)
+
+    idx = rbdb.data(RBDB.IDX)
+    offsets = [RBDB.entry_struct.unpack_from(idx, 24 + n * RBDB.ENTRY_LEN)[RBDB.IDX_TITLE]
+               for n in range(tracks)]
+    report(tracks, "_get_string_at_offset",
+           timed(lambda: [rbdb._get_string_at_offset(RBDB.IDX_TITLE, o) for o in offsets], repeat),
+           tracks, "strings")
+
+    def preload_scan():
+        preloaded = RBDB(root)
+        preloaded.preload()
+        return sum(1 for _ in preloaded.iter_entries())
+
+    report(tracks, "preload + iter_entries", timed(preload_scan, repeat), tracks)
+
+    def find():
+        # cold match keys every run, as a fresh process would have them
+        strstd.cache_clear()
+        r = RBDB(root)
+        return [i for key, indexes in r.key_index().items() if "ka" in key for i in indexes]
+
+    report(tracks, "--find", timed(find, repeat), tracks)
+
+def bench_commit(root, tracks, workdir, inplace):
+    # touch the play counts of 1% of the library, then commit a copy
+    copy = f"{workdir}/commit"
+    shutil.rmtree(copy, ignore_errors=True)
+    shutil.copytree(root, copy)
+
+    rbdb = RBDB(copy, access=mmap.ACCESS_COPY)
+    rbdb.update_many("PLAYCOUNT", [(24 + n * RBDB.ENTRY_LEN, 1) for n in range(0, tracks, 100)])
+    with contextlib.redirect_stdout(io.StringIO()):
+        seconds = timed(lambda: rbdb.commit(inplace=inplace))
+
+    report(tracks, "commit inplace" if inplace else "commit", seconds)
+
+def bench_lastfm(csv_path, root, scrobbles):
+    # parse only, then parse and import into the database, each timed
+    # without tracing and measured again under tracemalloc. Neither reads
+    # or writes the export's cache.
+    def parse():
+        strstd.cache_clear()
+        return LastFM(csv_path, cache=False)
+
+    def join():
+        # the whole import except commit(), writes stay in a private map
+        lastfm = parse()
+        rbdb = RBDB(root, access=mmap.ACCESS_COPY)
+        keys = rbdb.key_index()
+        matched, rbdb_only, lastfm_only = join_counts(keys, lastfm.counts)
+        return rbdb.import_counts((index, lastfm.counts[key])
+                                  for key in keys if key in matched for index in keys[key])
+
+    for name, fn in (("LastFM parse", parse), ("parse + import join", join)):
+        with contextlib.redirect_stdout(io.StringIO()):
+            seconds = timed(fn)
+            peak = peak_memory(fn)
+        report(scrobbles, name, seconds, scrobbles, "rows", peak)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark rbdbutil on synthetic data.")
+    parser.add_argument("--suites", nargs="+", choices=["rbdb", "lastfm"], default=["rbdb", "lastfm"])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000],
+                        help="database sizes in tracks")
+    parser.add_argument("--scrobbles", type=int, nargs="+", default=[1000000, 10000000],
+                        help="Last.fm export sizes in scrobbles")
+    parser.add_argument("--catalog", type=int, default=100000,
+                        help="database size the Last.fm exports are matched against")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workdir", help="keep generated databases in WORKDIR and reuse them")
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        workdir = args.workdir or tmpdir
+
+        def database(tracks):
+            root = f"{workdir}/rbdb_{tracks}"
+            if not os.path.exists(f"{root}/database_{RBDB.IDX}.tcd"):
+                generate_rbdb(root, tracks)
+            return root
+
+        if "rbdb" in args.suites:
+            for tracks in args.sizes:
+                root = database(tracks)
+                bench_rbdb(root, tracks, args.repeat)
+                bench_commit(root, tracks, workdir, inplace=False)
+                bench_commit(root, tracks, workdir, inplace=True)
+
+        if "lastfm" in args.suites:
+            root = database(args.catalog)
+            for scrobbles in args.scrobbles:
+                csv_path = f"{workdir}/lastfm_{args.catalog}_{scrobbles}.csv"
+                if not os.path.exists(csv_path):
+                    generate_lastfm(csv_path, scrobbles, args.catalog)
+                bench_lastfm(csv_path, root, scrobbles)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import random
+import itertools
+import struct
+import argparse
+
+from rbdbutil import RBDB, as_bytes
+
+TAGCACHE_MAGIC = 0x54434810
+
+syllables = ["ka", "lo", "mi", "ne", "ru", "sa", "to", "vi", "da", "fe",
+             "go", "ha", "ji", "ba", "ze", "qu", "or", "an", "el", "is"]
+
+def word(rnd, parts=(1, 3)):
+    return "".join(rnd.choice(syllables) for _ in range(rnd.randint(*parts))).capitalize()
+
+def name(rnd, words=(1, 3)):
+    return " ".join(word(rnd) for _ in range(rnd.randint(*words)))
+
+def catalog(tracks, seed=0):
+    # Albums of 8 to 14 tracks, about five albums per artist, a few
+    # composers and groupings shared across the whole library. Yields one
+    # dict per track with the RBDB string fields plus YEAR/TRACKNO/LEN.
+    rnd = random.Random(seed)
+    artists = [name(rnd) for _ in range(max(1, tracks // 50))]
+    composers = [name(rnd, (2, 3)) for _ in range(max(1, tracks // 200))]
+    groupings = ["", "Live", "Remaster", "Demo", "Bonus"]
+
+    n = 0
+    while n < tracks:
+        artist = rnd.choice(artists)
+        album = name(rnd, (1, 4))
+        year = rnd.randint(1960, 2024)
+        for trackno in range(1, rnd.randint(8, 14) + 1):
+            if n == tracks:
+                break
+            title = name(rnd, (1, 5))
+            yield {
+                "ARTIST": artist,
+                "ALBUM": album,
+                "TITLE": title,
+                "FILE": f"/Music/{artist}/{album}/{trackno:02d} - {title}.mp3",
+                "COMPOSER": rnd.choice(composers),
+                "COMMENT": "",
+                "ALBUMARTIST": artist,
+                "GROUPING": rnd.choice(groupings),
+                "CANONICALARTIST": artist,
+                "YEAR": year,
+                "DISCNO": 1,
+                "TRACKNO": trackno,
+                "BITRATE": rnd.choice((128, 192, 256, 320)),
+                "LEN": rnd.randint(90000, 480000),
+            }
+            n += 1
+
+class TagFile:
+    # Rockbox tag file: 12 byte header (magic, data size, entry count) and
+    # entries of (padded length, index id, NUL terminated string). Strings
+    # of shared tags are stored once and referenced by every track.
+    def __init__(self, shared):
+        self.shared = shared
+        self.data = bytearray(12)
+        self.offsets = {}
+        self.count = 0
+
+    def add(self, s, idx_id):
+        if self.shared and s in self.offsets:
+            return self.offsets[s]
+
+        offset = len(self.data)
+        encoded = s.encode() + b"\0"
+        _len = (len(encoded) + 7) & ~7
+        self.data += struct.pack("<Ii", _len, -1 if self.shared else idx_id)
+        self.data += encoded.ljust(_len, b"\0")
+        self.offsets[s] = offset
+        self.count += 1
+        return offset
+
+    def write(self, path):
+        struct.pack_into("<III", self.data, 0, TAGCACHE_MAGIC, len(self.data) - 12, self.count)
+        with open(path, "wb") as f:
+            f.write(self.data)
+
+def generate_rbdb(root, tracks, seed=0, played=0.3):
+    # Write database_idx.tcd and the tag files RBDB reads for a library of
+    # the given size, with a fraction of the tracks already played.
+    os.makedirs(root, exist_ok=True)
+    rnd = random.Random(seed + 1)
+    tags = { i: TagFile(i not in (RBDB.IDX_TITLE, RBDB.IDX_FILE)) for i in RBDB.file_indexes[1:] }
+    names = sorted(RBDB.positions, key=RBDB.positions.get)
+
+    idx = bytearray(24 + tracks * RBDB.ENTRY_LEN)
+    serial = 0
+    for n, track in enumerate(catalog(tracks, seed)):
+        values = dict(track)
+        for pos_name in names:
+            pos = RBDB.positions[pos_name]
+            if pos in tags:
+                values[pos_name] = tags[pos].add(track[pos_name], n)
+
+        if rnd.random() < played:
+            serial += 1
+            values["PLAYCOUNT"] = rnd.randint(1, 40)
+            values["PLAYTIME"] = min(values["PLAYCOUNT"] * track["LEN"], 0xffffffff)
+            values["LASTPLAYED"] = serial
+
+        RBDB.entry_struct.pack_into(idx, 24 + n * RBDB.ENTRY_LEN,
+                                    *[values.get(pos_name, 0) for pos_name in names])
+
+    idx[:24] = b"".join(as_bytes(x) for x in (TAGCACHE_MAGIC, tracks * RBDB.ENTRY_LEN,
+                                              tracks, serial, 1, 0))
+    with open(f"{root}/database_{RBDB.IDX}.tcd", "wb") as f:
+        f.write(idx)
+
+    for i, tag in tags.items():
+        tag.write(f"{root}/database_{i}.tcd")
+
+def generate_lastfm(path, scrobbles, tracks, seed=0, bom=True, exponent=1.1, unknown=0.1):
+    # Write a semicolon separated Last.fm export with Zipf distributed
+    # plays over the catalog generate_rbdb() uses for the same tracks and
+    # seed. A fraction of the plays are of tracks that aren't in it.
+    rnd = random.Random(seed + 2)
+    songs = [(t["ARTIST"], t["ALBUM"], t["TITLE"]) for t in catalog(tracks, seed)]
+    songs += [(t["ARTIST"], t["ALBUM"], t["TITLE"])
+              for t in catalog(max(1, int(tracks * unknown)), seed + 1000)]
+    rnd.shuffle(songs)
+    cum_weights = list(itertools.accumulate(1 / (rank ** exponent) for rank in range(1, len(songs) + 1)))
+
+    now = int(time.time())
+    with open(path, "w", encoding="utf-8-sig" if bom else "utf-8", newline="") as f:
+        f.write("Artist;Album;Track;Date\n")
+        done = 0
+        while done < scrobbles:
+            batch = min(100000, scrobbles - done)
+            for artist, album, title in rnd.choices(songs, cum_weights=cum_weights, k=batch):
+                now -= rnd.randint(60, 3600)
+                f.write(f"{artist};{album};{title};{time.strftime('%d %b %Y %H:%M', time.gmtime(now))}\n")
+            done += batch
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate synthetic test data for rbdbutil.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tracks", type=int, default=10000)
+    parser.add_argument("--dbdir", help="write a rockbox database to DBDIR")
+    parser.add_argument("--lastfm", help="write a Last.fm export of the same catalog to LASTFM")
+    parser.add_argument("--scrobbles", type=int, default=100000)
+    parser.add_argument("--no-bom", action="store_true")
+
+    args = parser.parse_args()
+
+    if not args.dbdir and not args.lastfm:
+        parser.error("nothing to do, give --dbdir and/or --lastfm")
+
+    if args.dbdir:
+        generate_rbdb(args.dbdir, args.tracks, seed=args.seed)
+
+    if args.lastfm:
+        generate_lastfm(args.lastfm, args.scrobbles, args.tracks, seed=args.seed, bom=not args.no_bom)
@@ -1,15 +1,29 @@
 #!/usr/bin/env python3
 
+import os
 import sys
 import csv
+import json
+import hashlib
 import struct
 import re
-import hashlib
+import mmap
+import time
+import cProfile
 import argparse
+import contextlib
+import pickle
+import functools
+import collections
+import concurrent.futures
 
 as_int = lambda x: int.from_bytes(x, byteorder='little')
 as_bytes = lambda x: int.to_bytes(x, byteorder='little', length=4)
 
+# Part of every cache stamp, bump it when strstd(), Track keys or what the
+# caches hold change so caches written before get rebuilt
+CACHE_VERSION = 2
+
 def stdtrack(track):
     # Remove leading track numbers from track title
     if (re.match(r'^[0-9][0-9]?[- ]', track)):
@@ -17,9 +31,13 @@ def stdtrack(track):
 
     return track
 
+@functools.lru_cache(maxsize=65536)
 def strstd(s):
+    # nothing after an opening parenthesis is relevant for matching, and
+    # none of the replacements below can introduce one
+    s = s.partition("(")[0]
+
     # remove characters irrelevant for matching
-    s = s.replace('\'', "")
     s = s.replace("'", "")
     s = s.replace("&", "and")
     s = s.replace("?", "")
@@ -31,24 +49,21 @@ def strstd(s):
     s = s.replace(" ", "")
     s = s.replace("á", "a").replace("é", "e").replace("í", "i").replace("ó", "o").replace("ú", "u")
     s = s.replace("Thirty", "30")
-    if "(" in s:
-        s = s.split('(')[0]
 
     return s.lower()
 
 class Track:
-    artist = None
-    album = None
-    title = None
+    # RBDB fields needed by from_rbdb_entry()
+    rbdb_fields = ("ARTIST", "ALBUM", "TITLE")
 
-    key = None
+    __slots__ = ("artist", "album", "title", "key")
 
-    def __init__(self, artist=None, album=None, title=None):
+    def __init__(self, artist=None, album=None, title=None, key=None):
         self.artist = artist
         self.album = album
         self.title = title
 
-        self.key = strstd(f"{artist}{album}{stdtrack(title)}")
+        self.key = key if key is not None else strstd(f"{artist}{album}{stdtrack(title)}")
 
 
     def eq(self, track):
@@ -92,9 +107,29 @@ class RBDB:
         IDX_CANONICALARTIST,
     ]
 
+    # tag files whose strings are shared by many tracks
+    shared_indexes = [
+        IDX_ARTIST,
+        IDX_ALBUM,
+        IDX_COMPOSER,
+        IDX_ALBUMARTIST,
+        IDX_GROUPING,
+        IDX_CANONICALARTIST,
+    ]
+
     paths = None
     datas = None
-    checksums = None
+    dirty = None
+    caches = None
+    tables = None
+    plans = None
+    keys = None
+
+    # work counters, reported by --stats
+    entries_decoded = 0
+    strings_decoded = 0
+    bytes_scanned = 0
+    fields_written = 0
     cur_offset = 0
 
     dbver = None
@@ -132,81 +167,294 @@ class RBDB:
     }
 
     ENTRY_LEN = 96
-
-
-    def __init__(self, root):
+    entry_struct = struct.Struct("<24I")
+    field_struct = struct.Struct("<I")
+
+
+    def __init__(self, root, access=mmap.ACCESS_READ, cache_size=4096, verbose=False):
+        # ACCESS_READ maps the files read-only, ACCESS_COPY keeps writes
+        # private until commit() and ACCESS_WRITE writes through to the files.
+        # cache_size bounds the per tag file LRU of decoded shared strings,
+        # None keeps every string and 0 disables caching. verbose prints
+        # every field update.
+        self.root = root
+        self.verbose = verbose
+        self.access = access
+        self.cache_size = cache_size
         self.paths = {}
         self.datas = {}
-        self.checksums = {}
+        self.dirty = {}
+        self.caches = {}
+        self.tables = {}
+        self.plans = {}
 
         for i in self.file_indexes:
             self.paths[i] = f"{root}/database_{i}.tcd"
-            self.datas[i] = bytearray(open(self.paths[i], "rb").read())
-            self.checksums[i] = hashlib.md5(self.datas[i])
 
-        self.dbver = as_int(self.datas[self.IDX][:4])
-        self.dbsize = as_int(self.datas[self.IDX][4:8])
-        self.dbcount = as_int(self.datas[self.IDX][8:12])
-        self.dbserial = as_int(self.datas[self.IDX][12:16])
-        self.dbcommit = as_int(self.datas[self.IDX][16:20])
-        self.dbdirty = as_int(self.datas[self.IDX][20:24])
+        if cache_size != 0:
+            for i in self.shared_indexes:
+                getter = functools.partial(self._get_string_at_offset, i)
+                self.caches[i] = functools.lru_cache(maxsize=cache_size)(getter)
+
+        header = self.data(self.IDX)[:24]
+        self.dbver = as_int(header[:4])
+        self.dbsize = as_int(header[4:8])
+        self.dbcount = as_int(header[8:12])
+        self.dbserial = as_int(header[12:16])
+        self.dbcommit = as_int(header[16:20])
+        self.dbdirty = as_int(header[20:24])
 
         self.cur_offset = 24
 
+    def data(self, fileidx):
+        # files are mapped on first use, tag files only once a string is read.
+        # ACCESS_COPY maps privately, a read-only descriptor is enough for it
+        if fileidx not in self.datas:
+            mode = "r+b" if self.access == mmap.ACCESS_WRITE else "rb"
+            with open(self.paths[fileidx], mode) as f:
+                self.datas[fileidx] = mmap.mmap(f.fileno(), 0, access=self.access)
+
+        return self.datas[fileidx]
 
-    def next_entry(self):
-        entry = self.entry(self.cur_offset)
+    def next_entry(self, fields=None):
+        entry = self.entry(self.cur_offset, fields)
         self.cur_offset += self.ENTRY_LEN
         return entry
 
     def _get_string_at_offset(self, tagidx, offset):
-        _len = as_int(self.datas[tagidx][offset:offset+4])
-        _idx = as_int(self.datas[tagidx][offset+4:offset+8])
-        _var = self.datas[tagidx][offset+8:offset+8+_len]
-        s = []
-        for x in _var:
-            if x == 0:
-                break
-            s.append(x)
+        data = self.data(tagidx)
+        _len = as_int(data[offset:offset+4])
+        start = offset + 8
+        end = data.find(b"\0", start, start + _len)
+        if end < 0:
+            end = start + _len
 
-        return bytes(s).decode()
+        self.strings_decoded += 1
+        self.bytes_scanned += end - offset
+        return data[start:end].decode()
 
     def artist(self, offset):
-        return _get_string_at_offset(self.IDX_ARTIST, offset)
-
-    def entry(self, entry_offset):
-        indexes = {}
+        return self.string_getter(self.IDX_ARTIST)(offset)
+
+    def entry(self, entry_offset, fields=None):
+        # fields limits decoding (and tag file mapping) to the given names
+        raw = self.entry_struct.unpack_from(self.data(self.IDX), entry_offset)
+        return self._decode(entry_offset, raw, self._plan(fields))
+
+    def iter_entries(self, fields=None, start=24):
+        # like entry(), fields limits decoding to the given names
+        idx = self.data(self.IDX)
+        end = start + (len(idx) - start) // self.ENTRY_LEN * self.ENTRY_LEN
+        plan = self._plan(fields)
+
+        with memoryview(idx) as view, view[start:end] as records:
+            for raw in self.entry_struct.iter_unpack(records):
+                yield self._decode(start, raw, plan)
+                start += self.ENTRY_LEN
+
+    def preload(self, tagidxs=None):
+        # Parse whole tag files front to back into offset -> str tables,
+        # cheaper than seeking around for every entry when most of the file
+        # will be read anyway.
+        for tagidx in self.file_indexes[1:] if tagidxs is None else tagidxs:
+            if tagidx in self.tables:
+                continue
+
+            data = self.data(tagidx)
+            table = {}
+            offset = 12
+            while offset + 8 <= len(data):
+                _len = as_int(data[offset:offset+4])
+                start = offset + 8
+                end = data.find(b"\0", start, start + _len)
+                if end < 0:
+                    end = start + _len
+                table[offset] = data[start:end].decode()
+                offset = start + _len
+
+            self.tables[tagidx] = table
+            # plans hold the getters of the strings now in tables
+            self.plans = {}
+            self.strings_decoded += len(table)
+            self.bytes_scanned += offset - 12
+
+    def tag_indexes(self, fields):
+        # tag files needed to decode the given fields
+        return [self.positions[f] for f in fields if self.positions[f] in self.file_indexes]
+
+    def string_getter(self, tagidx):
+        # offset -> str for a tag file, from the preloaded table if there is
+        # one, cached when the strings are shared
+        if tagidx in self.tables:
+            table = self.tables[tagidx]
+            fallback = functools.partial(self._get_string_at_offset, tagidx)
+            return lambda offset: table[offset] if offset in table else fallback(offset)
+
+        if tagidx in self.caches:
+            return self.caches[tagidx]
+
+        return functools.partial(self._get_string_at_offset, tagidx)
+
+    def cache_info(self):
+        return { i: cache.cache_info() for i, cache in self.caches.items() }
+
+    def parallel_map(self, jobs, func, *args, chunks_per_job=4):
+        # Run func(start, stop, *args) over slices of the index in worker
+        # processes that map the database read-only themselves, yielding
+        # what it returns for each slice in index order. Writes not
+        # committed yet are not visible to the workers.
+        count = (len(self.data(self.IDX)) - 24) // self.ENTRY_LEN
+        step = max(1, -(-count // (jobs * chunks_per_job)))
+        starts = [24 + i * self.ENTRY_LEN for i in range(0, count, step)]
+        stops = [min(start + step * self.ENTRY_LEN, 24 + count * self.ENTRY_LEN) for start in starts]
+
+        tables = list(self.tables)
+        with concurrent.futures.ProcessPoolExecutor(jobs, initializer=_scan_init,
+                initargs=(self.root, self.cache_size, tables)) as executor:
+            yield from executor.map(func, starts, stops, *[[arg] * len(starts) for arg in args])
+
+    def parallel_entries(self, jobs, fields=None):
+        # Same entries as iter_entries(), decoded by worker processes. They
+        # send back plain tuples, much cheaper to pickle than dicts.
+        names = ["index"] + [pos_name for pos_name, _, _ in self._plan(fields)]
+        for entries in self.parallel_map(jobs, _scan_range, fields):
+            for values in entries:
+                yield dict(zip(names, values))
+
+    def scan(self, fields=None, jobs=1):
+        if jobs > 1:
+            return self.parallel_entries(jobs, fields)
+
+        return self.iter_entries(fields)
+
+    def _plan(self, fields):
+        # (name, position, string getter) for every field to decode, the
+        # getter is None for fields stored in the index itself. Built once
+        # per fields, entry() gets called for one entry at a time.
+        key = None if fields is None else tuple(fields)
+        if key not in self.plans:
+            self.plans[key] = [(pos_name, pos_offset,
+                                self.string_getter(pos_offset) if pos_offset in self.file_indexes else None)
+                               for pos_name, pos_offset in self.positions.items()
+                               if fields is None or pos_name in fields]
+
+        return self.plans[key]
+
+    def _decode(self, entry_offset, raw, plan):
+        self.entries_decoded += 1
         values = { "index": entry_offset }
 
-        for pos_name, pos_offset in self.positions.items():
-            offset = entry_offset + (pos_offset * 4)
-            _idx = self.datas[self.IDX][offset:offset + 4]
-            values[pos_name] = as_int(_idx)
-
-            # value is mapped in a different file
-            if pos_offset in self.file_indexes:
-                file_idx = pos_offset
-                values[pos_name] = self._get_string_at_offset(file_idx, values[pos_name])
+        for pos_name, pos_offset, getter in plan:
+            if getter is not None:
+                values[pos_name] = getter(raw[pos_offset])
+            else:
+                values[pos_name] = raw[pos_offset]
 
         return values
 
+    def as_array(self):
+        # zero-copy structured view over the index records, one uint32
+        # column per field; writable unless the map is read-only, but only
+        # writes made through update_many() are seen by commit()
+        try:
+            import numpy as np
+        except ImportError:
+            raise RuntimeError("as_array() requires numpy")
+
+        dtype = np.dtype([(name, "<u4") for name in sorted(self.positions, key=self.positions.get)])
+        idx = self.data(self.IDX)
+        count = (len(idx) - 24) // self.ENTRY_LEN
+        return np.frombuffer(idx, dtype=dtype, count=count, offset=24)
+
+    def key_index(self, cache_path=None, jobs=1):
+        # Track match key -> offsets of the entries with that key, optionally
+        # persisted in cache_path. Rockbox bumps the commit id whenever it
+        # rebuilds the database, so together with the tag file stamps that
+        # tells a stale cache apart from one only our play counts changed.
+        if self.keys is not None:
+            return self.keys
+
+        stamp = [CACHE_VERSION, self.dbcommit, os.path.getsize(self.paths[self.IDX])]
+        for i in self.tag_indexes(Track.rbdb_fields):
+            st = os.stat(self.paths[i])
+            stamp.append((st.st_size, st.st_mtime_ns))
+
+        if cache_path:
+            # anything unreadable is rebuilt like a stale cache
+            try:
+                with open(cache_path, "rb") as f:
+                    cached_stamp, keys = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError, ValueError, TypeError,
+                    AttributeError, ImportError):
+                cached_stamp = None
+            if isinstance(cached_stamp, list) and cached_stamp == stamp and isinstance(keys, dict):
+                self.keys = keys
+                return keys
+
+        keys = {}
+        if jobs > 1:
+            # match keys are worked out by the workers too
+            for pairs in self.parallel_map(jobs, _scan_keys):
+                for key, index in pairs:
+                    keys.setdefault(key, []).append(index)
+        else:
+            for entry in self.iter_entries(Track.rbdb_fields):
+                keys.setdefault(Track.from_rbdb_entry(entry).key, []).append(entry["index"])
+
+        if cache_path:
+            with open(cache_path, "wb") as f:
+                pickle.dump((stamp, keys), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        self.keys = keys
+        return keys
+
     def EOF(self):
-        return self.cur_offset >= len(self.datas[self.IDX])
+        return self.cur_offset >= len(self.data(self.IDX))
 
     def update_numeric_field(self, index, field_name, newvalue):
-        print(f"Update {field_name} for index {index}: {newvalue}")
+        if self.verbose:
+            print(f"Update {field_name} for index {index}: {newvalue}")
         offset = index + (self.positions[field_name] * 4)
-        newvalue_as_bytes = as_bytes(newvalue)
-        for x in range(len(newvalue_as_bytes)):
-            self.datas[self.IDX][offset + x] = newvalue_as_bytes[x]
+        self.field_struct.pack_into(self.data(self.IDX), offset, newvalue)
+        self.mark_dirty(self.IDX, offset, offset + 4)
+
+    def update_many(self, field_name, updates):
+        # Set field_name for many entries at once, updates being
+        # (index, value) pairs. Uses a NumPy column assignment when numpy
+        # has already been loaded, struct.pack_into otherwise: importing it
+        # just for this costs more than the writes of a typical import.
+        updates = list(updates)
+        if not updates:
+            return
+
+        # checked up front so both ways fail the same
+        values = [value for _, value in updates]
+        if min(values) < 0 or max(values) > 0xffffffff:
+            raise ValueError(f"{field_name} value out of range")
+
+        pos = self.positions[field_name] * 4
+        np = sys.modules.get("numpy")
+        if np is not None:
+            records = (np.array([index for index, _ in updates]) - 24) // self.ENTRY_LEN
+            self.as_array()[field_name][records] = values
+        else:
+            idx = self.data(self.IDX)
+            pack_into = self.field_struct.pack_into
+            for index, value in updates:
+                pack_into(idx, index + pos, value)
+
+        for index, value in updates:
+            if self.verbose:
+                print(f"Update {field_name} for index {index}: {value}")
+            self.mark_dirty(self.IDX, index + pos, index + pos + 4)
 
     def get_numeric_field(self, index, field_name):
         offset = index + (self.positions[field_name] * 4)
-        return as_int(self.datas[self.IDX][offset:offset+4])
+        return as_int(self.data(self.IDX)[offset:offset+4])
 
     def update_entry(self, index, playcount=None, update_playtime=False):
         if playcount is not None:
-            self.update_numeric_field(self.index, "PLAYCOUNT", playcount)
+            self.update_numeric_field(index, "PLAYCOUNT", playcount)
 
         if update_playtime:
             playcount = self.get_numeric_field(index, "PLAYCOUNT")
@@ -214,78 +462,453 @@ class RBDB:
             new_playtime = playcount * _len
             self.update_numeric_field(index, "PLAYTIME", new_playtime)
 
-    def commit(self):
-        for i, d in self.datas.items():
-            orig_sum = self.checksums[i]
-            new_sum = hashlib.md5(d)
-            if orig_sum.hexdigest() != new_sum.hexdigest():
-                print(f"{self.paths[i]} changed {orig_sum.hexdigest()} != {new_sum.hexdigest()}")
+    def import_counts(self, matches):
+        # Raise PLAYCOUNT to the Last.fm count for every (index, count) in
+        # matches where Last.fm has more plays, and fill in PLAYTIME for
+        # played entries that have none, as two batched updates. Returns the
+        # number of entries looked at.
+        idx = self.data(self.IDX)
+        unpack_from = self.entry_struct.unpack_from
+        playcount_pos = self.positions["PLAYCOUNT"]
+        playtime_pos = self.positions["PLAYTIME"]
+        len_pos = self.positions["LEN"]
+
+        playcounts = []
+        playtimes = []
+        done = 0
+        for index, lastfm_playcount in matches:
+            raw = unpack_from(idx, index)
+            entry_playcount = raw[playcount_pos]
+
+            # only update if lastfm has more plays.
+            playcount = entry_playcount
+            if lastfm_playcount > entry_playcount:
+                playcount = lastfm_playcount
+                playcounts.append((index, playcount))
+
+            if entry_playcount > 0 and raw[playtime_pos] == 0:
+                playtimes.append((index, playcount * raw[len_pos]))
+
+            done += 1
+
+        self.update_many("PLAYCOUNT", playcounts)
+        self.update_many("PLAYTIME", playtimes)
+        return done
+
+    def add_plays(self, index, plays):
+        # Count plays made elsewhere as if they happened on the player, which
+        # stamps LASTPLAYED with the next database serial.
+        self.update_numeric_field(index, "PLAYCOUNT", self.get_numeric_field(index, "PLAYCOUNT") + plays)
+        playtime = self.get_numeric_field(index, "PLAYTIME") + plays * self.get_numeric_field(index, "LEN")
+        self.update_numeric_field(index, "PLAYTIME", playtime)
+
+        self.dbserial += 1
+        self.data(self.IDX)[12:16] = as_bytes(self.dbserial)
+        self.mark_dirty(self.IDX, 12, 16)
+        self.update_numeric_field(index, "LASTPLAYED", self.dbserial)
+
+    def mark_dirty(self, fileidx, start, end):
+        self.fields_written += 1
+        self.dirty.setdefault(fileidx, []).append((start, end))
+
+    def dirty_ranges(self, fileidx):
+        # sorted, coalesced (start, end) byte ranges written since load
+        ranges = []
+        for start, end in sorted(self.dirty.get(fileidx, ())):
+            if ranges and start <= ranges[-1][1]:
+                ranges[-1] = (ranges[-1][0], max(end, ranges[-1][1]))
+            else:
+                ranges.append((start, end))
+
+        return ranges
+
+    def commit(self, inplace=False):
+        # inplace only writes the dirty ranges back into the existing files
+        # rather than rewriting them whole, easier on flash storage
+        for i in list(self.dirty):
+            ranges = self.dirty_ranges(i)
+            print(f"{self.paths[i]} changed, {len(ranges)} ranges,",
+                  f"{sum(end - start for start, end in ranges)} bytes")
+            if self.access == mmap.ACCESS_WRITE:
+                self.datas[i].flush()
+            elif inplace:
+                self.write_ranges(i, ranges)
+            else:
                 self.overwrite(i)
 
+        self.dirty = {}
+
+    def write_ranges(self, index, ranges):
+        data = self.datas[index]
+        fd = os.open(self.paths[index], os.O_WRONLY)
+        try:
+            for start, end in ranges:
+                os.pwrite(fd, data[start:end], start)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
     def overwrite(self, index):
+        # copy out before truncating the file backing the map
+        data = bytes(self.datas[index])
         with open(self.paths[index], "wb") as f:
-            f.write(bytes(self.datas[index]))
-        
+            f.write(data)
+
+
+# RBDB of a parallel_map() worker process
+_scan_rbdb = None
+
+def _scan_init(root, cache_size, preload):
+    global _scan_rbdb
+    _scan_rbdb = RBDB(root, cache_size=cache_size)
+    _scan_rbdb.preload(preload)
+
+def _scan_entries(start, stop, fields):
+    plan = _scan_rbdb._plan(fields)
+    idx = _scan_rbdb.data(RBDB.IDX)
+    for offset in range(start, stop, RBDB.ENTRY_LEN):
+        yield _scan_rbdb._decode(offset, RBDB.entry_struct.unpack_from(idx, offset), plan)
+
+def _scan_range(start, stop, fields):
+    return [tuple(entry.values()) for entry in _scan_entries(start, stop, fields)]
+
+def _scan_keys(start, stop):
+    return [(Track.from_rbdb_entry(entry).key, entry["index"])
+            for entry in _scan_entries(start, stop, Track.rbdb_fields)]
+
+
+def count_scrobbles(path, fieldnames, start, end):
+    # Count the scrobbles between two line boundaries of an export, along
+    # with the match key of every distinct (artist, album, title) and the
+    # byte offsets of the first and last rows it's on. Exports don't have
+    # line breaks within fields, so any line start is a row start.
+    rows = collections.Counter()
+    seen = {}
+    row_start = start
+
+    def lines(f):
+        nonlocal row_start
+        pos = start
+        for line in f:
+            if pos >= end:
+                break
+            row_start = pos
+            pos += len(line)
+            yield line.decode()
+
+    with open(path, "rb") as f:
+        f.seek(start)
+        for row in csv.DictReader(lines(f), fieldnames=fieldnames, delimiter=';'):
+            artist = row.get("Artist").strip().lower()
+            album = row.get("Album").strip().lower()
+            title = row.get("Track").strip().lower()
+            t = (artist, album, title)
+            rows[t] += 1
+            seen[t] = (seen[t][0] if t in seen else row_start, row_start)
+
+    keys = { t: Track(*t).key for t in rows }
+    return rows, keys, seen
+
+
+def export_rows(path, wanted=()):
+    # Number of rows after the header line of an export, and
+    # { row: (byte offset, line) } for the wanted row numbers, negative ones
+    # counting from the end.
+    with open(path, "rb") as f:
+        f.readline()
+        first = f.tell()
+        total = sum(1 for _ in f)
+
+        rows = {}
+        targets = { w % total for w in wanted if -total <= w < total }
+        if targets:
+            f.seek(first)
+            pos = first
+            for row, line in enumerate(f):
+                if row in targets:
+                    rows[row] = (pos, line)
+                    if len(rows) == len(targets):
+                        break
+                pos += len(line)
+
+    return total, rows
+
+def row_digest(line):
+    return hashlib.sha1(line.rstrip(b"\r\n")).hexdigest()
+
 
 class LastFM:
-    data = None
-    def __init__(self, csv_path):
+    counts = None
+    tracks = None
+    # key -> byte offsets of the first and last rows the track is on
+    seen = None
+
+    # distinct values and total plays, kept up to date as tracks are added
+    artists = None
+    albums = None
+    titles = None
+    scrobbles = 0
+    def __init__(self, csv_path, rebuild_cache=False, span=None, jobs=1, cache=True):
+        # Aggregated counts are cached next to the export and reused until
+        # its size or mtime change, unless cache is False. A (start, end)
+        # byte span only counts the scrobbles in it, see new_rows().
         self.path = csv_path
-        self._parse()
-
-    def _parse(self):
-
-        self.data = {}
-
-        with open(self.path) as f:
-            csvdata = f.read()
-            if csvdata.startswith('\ufeff'):
-                csvdata = csvdata[1:]
-            csvdata_lines = csvdata.split("\n")
-            row_count = len(csvdata_lines) - 1
-
-            i = 0
-            r = csv.DictReader(csvdata_lines, delimiter=';')
-            for row in r:
-                artist = row.get("Artist").strip().lower()
-                album = row.get("Album").strip().lower()
-                title = row.get("Track").strip().lower()
-                i += 1
-        
-                track = Track(artist=artist, album=album, title=title)
-                if track.key not in self.data:
-                    self.data[track.key] = {
-                        "count": 1,
-                        "track": track,
-                    }
-                else:
-                    self.data[track.key]["count"] += 1
+        self.cache_path = f"{csv_path}.cache"
+
+        if span or not cache:
+            self._parse(*(span or ()), jobs=jobs)
+        elif rebuild_cache or not self._load_cache():
+            self._parse(jobs=jobs)
+            self._save_cache()
+
+    # Which rows of an export were imported into a database is recorded in
+    # the database directory as the number of rows and digests of the first
+    # and last of them, along with the database commit id. Rockbox bumps
+    # that whenever it rebuilds the database, which starts over.
+    @staticmethod
+    def load_mark(path, commit):
+        try:
+            with open(path) as f:
+                mark = json.load(f)
+        except (OSError, ValueError):
+            return None
 
-    def count(self):
-        return len(self.data)
+        return mark if mark.get("commit") == commit else None
 
-    def artist_count(self):
-        return len(set([ x["track"].artist.lower() for x in self.data.values()]))
+    def save_mark(self, path, commit):
+        total, rows = export_rows(self.path, (0, -1))
+        mark = { "commit": commit, "rows": total }
+        if total:
+            mark["first"] = row_digest(rows[0][1])
+            mark["last"] = row_digest(rows[total - 1][1])
 
-    def album_count(self):
-        return len(set([ x["track"].album.lower() for x in self.data.values()]))
+        with open(path, "w") as f:
+            json.dump(mark, f)
 
-    def exists(self, track):
-        return self.data.get(track.key, None)
+    @staticmethod
+    def new_rows(csv_path, mark):
+        # (start, end) byte span of the rows added to the export since mark
+        # and whether it lists the newest first, None if the rows the mark
+        # covers aren't at either end of it any more. Exports listed oldest
+        # first grow at the end, the ones listed newest first at the top.
+        if not mark or not mark.get("rows"):
+            return None
+
+        n = mark["rows"]
+        total, rows = export_rows(csv_path, (0, n - 1, -n, -1))
+        if n > total:
+            return None
+
+        matches = lambda a, b: (row_digest(rows[a % total][1]) == mark["first"] and
+                                row_digest(rows[b % total][1]) == mark["last"])
+        size = os.path.getsize(csv_path)
+        if n == total:
+            return ((size, size), False) if matches(0, -1) else None
+
+        head, tail = matches(0, n - 1), matches(-n, -1)
+        if head and not tail:
+            offset, line = rows[n - 1]
+            return ((offset + len(line), size), False)
+        if tail and not head:
+            return ((rows[0][0], rows[total - n][0]), True)
+
+        return None
+
+    def _stamp(self):
+        st = os.stat(self.path)
+        return (CACHE_VERSION, st.st_size, st.st_mtime_ns)
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_path, "rb") as f:
+                stamp, counts, tracks, seen = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            return False
+
+        if stamp != self._stamp():
+            return False
+
+        self._reset()
+        for t in tracks:
+            self._add(Track(*t), counts[t[3]], seen[t[3]])
+        return True
+
+    def _save_cache(self):
+        try:
+            with open(self.cache_path, "wb") as f:
+                # plain tuples, Track may live in __main__
+                tracks = [(t.artist, t.album, t.title, t.key) for t in self.tracks.values()]
+                pickle.dump((self._stamp(), self.counts, tracks, self.seen), f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+        except OSError as e:
+            print(f"Can't write {self.cache_path}: {e}")
+
+    def _parse(self, start=0, end=None, jobs=1):
+        # Scrobbles are counted per distinct (artist, album, title) first,
+        # so Track objects and match keys are only built once per track.
+        # With several jobs the export is split at line boundaries and the
+        # chunks are counted in worker processes, then merged in file order
+        # so the result is the same as counting it in one go.
+        with open(self.path, "rb") as f:
+            # utf-8-sig drops the BOM exports start with
+            fieldnames = next(csv.reader([f.readline().decode("utf-8-sig")], delimiter=';'))
+            start = max(start, f.tell())
+            end = os.fstat(f.fileno()).st_size if end is None else end
+
+            bounds = [start]
+            for i in range(1, jobs):
+                f.seek(start + (end - start) * i // jobs)
+                f.readline()
+                bounds.append(max(min(f.tell(), end), bounds[-1]))
+            bounds.append(end)
+
+        chunks = [(self.path, fieldnames, a, b) for a, b in zip(bounds, bounds[1:])]
+        if jobs > 1:
+            with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+                parts = list(executor.map(count_scrobbles, *zip(*chunks)))
+        else:
+            parts = [count_scrobbles(*chunk) for chunk in chunks]
+
+        rows = collections.Counter()
+        keys = {}
+        seen = {}
+        for part_rows, part_keys, part_seen in parts:
+            rows.update(part_rows)
+            keys.update(part_keys)
+            for t, (first, last) in part_seen.items():
+                seen[t] = (seen[t][0] if t in seen else first, last)
+
+        self._reset()
+        for (artist, album, title), count in rows.items():
+            key = keys[(artist, album, title)]
+            self._add(Track(artist=sys.intern(artist), album=sys.intern(album), title=title, key=key), count,
+                      seen[(artist, album, title)])
+
+    def _reset(self):
+        self.counts = collections.Counter()
+        self.tracks = {}
+        self.seen = {}
+        self.artists = set()
+        self.albums = set()
+        self.titles = set()
+        self.scrobbles = 0
+
+    def _add(self, track, count, seen):
+        self.counts[track.key] += count
+        self.scrobbles += count
+        first, last = seen
+        if track.key in self.seen:
+            first, last = min(first, self.seen[track.key][0]), max(last, self.seen[track.key][1])
+        self.seen[track.key] = (first, last)
+        if track.key not in self.tracks:
+            self.tracks[track.key] = track
+            self.artists.add(track.artist)
+            self.albums.add(track.album)
+            self.titles.add(track.title)
 
+    def count(self):
+        return len(self.counts)
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--dbdir", required=True)
-    parser.add_argument("--lastfm")
-    parser.add_argument("--info", "-I", action="store_true")
-    parser.add_argument("--find", )
-    parser.add_argument("--list-tracks", "-L", action="store_true")
-    parser.add_argument("--import-counts", action="store_true")
+    def artist_count(self):
+        return len(self.artists)
 
-    args = parser.parse_args()
+    def album_count(self):
+        return len(self.albums)
+
+    def title_count(self):
+        return len(self.titles)
 
-    rbdb = RBDB(args.dbdir)
+    def exists(self, track):
+        # scrobble count for the track, None if it was never played
+        return self.counts.get(track.key, None)
+
+
+class Stats:
+    # Wall time of each phase of a run along with how much work the
+    # watched RBDB and LastFM objects did in it. The objects keep plain int
+    # counters, so this costs next to nothing unless it's printed.
+    counter_names = ("entries_decoded", "strings_decoded", "bytes_scanned",
+                     "keys_normalized", "fields_written", "scrobbles")
+
+    def __init__(self):
+        self.phases = {}
+        self.sources = []
+
+    def watch(self, obj):
+        self.sources.append(obj)
+        return obj
+
+    def counters(self):
+        counters = { name: sum(getattr(o, name, 0) for o in self.sources) for name in self.counter_names }
+        counters["keys_normalized"] = strstd.cache_info().misses
+
+        # string cache hits and misses per tag file, to tune --cache-size
+        names = { v: k.lower() for k, v in RBDB.positions.items() }
+        caches = collections.Counter()
+        for o in self.sources:
+            if isinstance(o, RBDB):
+                for i, info in o.cache_info().items():
+                    caches[f"{names[i]}_cache_hits"] += info.hits
+                    caches[f"{names[i]}_cache_misses"] += info.misses
+        counters.update(caches)
+        return counters
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        before = self.counters()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            after = self.counters()
+            self.phases[name] = {
+                "seconds": seconds,
+                "counters": { k: after[k] - before.get(k, 0) for k in after if after[k] != before.get(k, 0) },
+            }
+
+    def report(self):
+        total = sum(p["seconds"] for p in self.phases.values())
+        return { "seconds": total, "phases": self.phases, "counters": self.counters() }
+
+    def print_report(self):
+        report = self.report()
+        print(f"Stats: {report['seconds']:.3f}s total")
+        for name, p in report["phases"].items():
+            rates = ", ".join(f"{count} {counter} ({count / p['seconds']:,.0f}/s)" if p["seconds"] else f"{count} {counter}"
+                              for counter, count in p["counters"].items())
+            print(f"  {name:<16} {p['seconds']:8.3f}s  {rates}".rstrip())
+
+
+def join_counts(keys, counts):
+    # Hash join of RBDB.key_index() with LastFM.counts on the match key:
+    # keys in both, keys only in the database, keys only in Last.fm.
+    return keys.keys() & counts.keys(), keys.keys() - counts.keys(), counts.keys() - keys.keys()
+
+
+def count_calls(counter, owner, name, label):
+    # Replace owner.name with a wrapper counting calls into counter[label].
+    # Meant for --profile, installed before anything gets bound to it.
+    func = getattr(owner, name)
+
+    @functools.wraps(func)
+    def counted(*args, **kwargs):
+        counter[label] += 1
+        return func(*args, **kwargs)
+
+    # keep lru_cache introspection working
+    for attr in ("cache_info", "cache_clear"):
+        if hasattr(func, attr):
+            setattr(counted, attr, getattr(func, attr))
+
+    setattr(owner, name, counted)
+
+
+def main(args, stats):
+    with stats.phase("open"):
+        rbdb = stats.watch(RBDB(args.dbdir, access=mmap.ACCESS_COPY if args.import_counts else mmap.ACCESS_READ,
+                                cache_size=None if args.cache_size < 0 else args.cache_size,
+                                verbose=args.verbose))
 
     print(f"File: {rbdb.paths[rbdb.IDX]}")
     print(f"Version: {rbdb.dbver}, Size: {rbdb.dbsize}, "
@@ -293,51 +916,160 @@ if __name__ == '__main__':
             f"Commit: {rbdb.dbcommit}, Dirty: {rbdb.dbdirty}")
 
     if args.info:
-        sys.exit(0)
+        return
 
-    lastfm = LastFM(args.lastfm) if args.lastfm else None
-    if lastfm:
+    if args.list_tracks:
+        fields = ("ARTIST", "YEAR", "ALBUM", "TRACKNO", "TITLE", "LASTPLAYED", "PLAYTIME")
+    elif args.find:
+        fields = Track.rbdb_fields
+    else:
+        fields = Track.rbdb_fields + ("PLAYCOUNT", "PLAYTIME")
+
+    if args.preload:
+        with stats.phase("preload"):
+            rbdb.preload(rbdb.tag_indexes(fields))
+
+    mark_path = f"{args.dbdir}/lastfm_import.json"
+    new_rows = None
+    if args.lastfm and args.incremental:
+        new_rows = LastFM.new_rows(args.lastfm, LastFM.load_mark(mark_path, rbdb.dbcommit))
+    span, newest_first = new_rows or (None, False)
+
+    lastfm = None
+    if args.lastfm:
+        with stats.phase("lastfm"):
+            lastfm = stats.watch(LastFM(args.lastfm, rebuild_cache=args.rebuild_cache, span=span,
+                                        jobs=args.jobs))
         print(f"LastFM tracks: {lastfm.count()}, artists: {lastfm.artist_count()},",
-              f"albums: {lastfm.album_count()}")
+              f"albums: {lastfm.album_count()}, titles: {lastfm.title_count()},",
+              f"scrobbles: {lastfm.scrobbles}")
 
     if args.list_tracks:
-        while not rbdb.EOF():
-            entry = rbdb.next_entry()
-            print(f"{entry.get('ARTIST')} - {entry.get('YEAR')}"
-                  f"- {entry.get('ALBUM')} - {entry.get('TRACKNO'):02d}"
-                  f" - {entry.get('TITLE')} - {entry.get('LASTPLAYED')}, {entry.get('PLAYTIME')}")
-        sys.exit(0)
+        with stats.phase("list tracks"):
+            for entry in rbdb.scan(fields, args.jobs):
+                print(f"{entry.get('ARTIST')} - {entry.get('YEAR')}"
+                      f"- {entry.get('ALBUM')} - {entry.get('TRACKNO'):02d}"
+                      f" - {entry.get('TITLE')} - {entry.get('LASTPLAYED')}, {entry.get('PLAYTIME')}")
+        return
+
+    if not (args.find or args.import_counts):
+        return
+
+    with stats.phase("key index"):
+        keys = rbdb.key_index(args.key_cache, args.jobs)
 
     if args.find:
-        while not rbdb.EOF():
-            entry = rbdb.next_entry()
-            track = Track.from_rbdb_entry(entry)
-            if args.find.lower() in track.key:
-                print(track)
-        sys.exit(0)
-
-    if args.import_counts:
-        done = 0
-        missing = 0
-        while not rbdb.EOF():
-            entry = rbdb.next_entry()
-            track = Track.from_rbdb_entry(entry)
-            if lastfm_entry := lastfm.exists(track):
-                entry_playcount = entry.get("PLAYCOUNT")
-                lastfm_playcount = lastfm_entry.get("count")
-
-                # only update if lastfm has more plays.
-                if lastfm_playcount > entry_playcount:
-                    rbdb.update_entry(entry.get("index"), playcount=lastfm_entry.get("count"))
-
-                if entry.get("PLAYCOUNT") > 0 and entry.get("PLAYTIME") == 0:
-                    rbdb.update_entry(entry.get("index"), update_playtime=True)
-
-                done += 1
-            else:
-                missing += 1
+        with stats.phase("find"):
+            find = args.find.lower()
+            matches = [index for key, indexes in keys.items() if find in key for index in indexes]
+            for index in sorted(matches):
+                print(Track.from_rbdb_entry(rbdb.entry(index, fields)))
+        return
+
+    with stats.phase("join"):
+        matched, rbdb_only, lastfm_only = join_counts(keys, lastfm.counts)
+
+    with stats.phase("import"):
+        if span:
+            # lastfm only holds the new scrobbles, add them on top in the
+            # order of each track's latest play, so the last one played gets
+            # the highest LASTPLAYED serial
+            latest = lambda key: -lastfm.seen[key][0] if newest_first else lastfm.seen[key][1]
+            done = 0
+            for key in sorted(matched, key=latest):
+                for index in keys[key]:
+                    rbdb.add_plays(index, lastfm.counts[key])
+                    done += 1
+        else:
+            # in database order, matched is a set and its order changes from
+            # run to run
+            done = rbdb.import_counts((index, lastfm.counts[key])
+                                      for key in keys if key in matched for index in keys[key])
+
+    if span:
+        # entries missing from the new scrobbles were most likely matched
+        # by an earlier import, counting them says nothing
+        print("Import: Done", done, "Last.fm only", len(lastfm_only))
+    else:
+        missing = sum(len(keys[key]) for key in rbdb_only)
+        print("Import: Done", done, "Missing", missing, "Last.fm only", len(lastfm_only))
+
+    if args.show_missing:
+        for key in sorted(lastfm_only, key=lambda key: (-lastfm.counts[key], key)):
+            track = lastfm.tracks[key]
+            print(f"{lastfm.counts[key]:>6} {track.artist} - {track.album} - {track.title}")
+
+    with stats.phase("commit"):
+        rbdb.commit(inplace=args.inplace)
+        lastfm.save_mark(mark_path, rbdb.dbcommit)
+
 
-        print("Import: Done", ok, "Missing", ko)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dbdir", required=True)
+    parser.add_argument("--lastfm")
+    parser.add_argument("--rebuild-cache", action="store_true",
+                        help="reparse the Last.fm export even if its cache is up to date")
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+                        help="worker processes used to parse the Last.fm export and scan the database")
+    parser.add_argument("--verbose", "-v", action="store_true",
+                        help="print every field update")
+    parser.add_argument("--info", "-I", action="store_true")
+    parser.add_argument("--find", )
+    parser.add_argument("--list-tracks", "-L", action="store_true")
+    parser.add_argument("--import-counts", action="store_true")
+    parser.add_argument("--show-missing", action="store_true",
+                        help="list the Last.fm tracks not found in the database")
+    parser.add_argument("--inplace", action="store_true",
+                        help="write back only the changed bytes instead of whole files")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only import scrobbles added to the export since its last import into this database")
+    parser.add_argument("--cache-size", type=int, default=4096,
+                        help="decoded strings kept per shared tag file, -1 for unbounded, --stats shows hits and misses")
+    parser.add_argument("--preload", action="store_true",
+                        help="parse whole tag files up front, faster for full scans")
+    parser.add_argument("--key-cache", metavar="FILE",
+                        help="persist the track match key index in FILE")
+
+    parser.add_argument("--stats", action="store_true",
+                        help="print how long each phase took and how much work it did")
+    parser.add_argument("--stats-json", metavar="FILE",
+                        help="write the --stats report to FILE as JSON")
+
+    parser.add_argument("--profile", metavar="FILE",
+                        help="run under cProfile, write pstats to FILE and print hot path call counts")
 
-        rbdb.commit()
+    args = parser.parse_args()
 
+    calls = collections.Counter()
+    if args.profile:
+        # neither cProfile nor the call counters see into worker processes
+        if args.jobs > 1:
+            print(f"--profile runs with --jobs 1 instead of {args.jobs}")
+            args.jobs = 1
+        module = sys.modules[__name__]
+        # every entry decoded goes through _decode(), whichever way it's read
+        count_calls(calls, RBDB, "_decode", "RBDB._decode")
+        count_calls(calls, RBDB, "_get_string_at_offset", "RBDB._get_string_at_offset")
+        count_calls(calls, module, "strstd", "strstd")
+        count_calls(calls, Track, "__init__", "Track.__init__")
+
+    stats = Stats()
+    try:
+        if args.profile:
+            profile = cProfile.Profile()
+            try:
+                profile.runcall(main, args, stats)
+            finally:
+                profile.dump_stats(args.profile)
+                print(f"Profile written to {args.profile}")
+                for label in ("RBDB._decode", "RBDB._get_string_at_offset", "strstd", "Track.__init__"):
+                    print(f"  {label:<28} {calls[label]:>10} calls")
+        else:
+            main(args, stats)
+    finally:
+        if args.stats:
+            stats.print_report()
+        if args.stats_json:
+            with open(args.stats_json, "w") as f:
+                json.dump(stats.report(), f, indent=2)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+from rbdbutil import RBDB, LastFM, Track, export_rows, strstd
+from rbdbgen import catalog, generate_rbdb
+
+# Match keys as produced by the original strstd(), which did the
+# replacements first and cut at "(" last. Run with python -m unittest.
+golden = [
+    ("Don't Stop Me Now", "dontstopmenow"),
+    ("Simon & Garfunkel", "simonandgarfunkel"),
+    ("Are You Experienced?", "areyouexperienced"),
+    ("Hello, Goodbye", "hellogoodbye"),
+    ("Jay-Z", "jayz"),
+    ("Help!", "help"),
+    ("Mr. Brightside", "mrbrightside"),
+    ("Rock `n` Roll", "rocknroll"),
+    ("  Spaced  Out  ", "spacedout"),
+    ("AC/DC", "ac/dc"),
+    ("", ""),
+    ("Sigur Rós", "sigurros"),
+    ("Canción Añejo", "cancionañejo"),
+    ("Él Camión Íntimo Ópera Último", "élcamioníntimoóperaúltimo"),
+    ("Thirty Seconds to Mars", "30secondstomars"),
+    ("thirty seconds", "thirtyseconds"),
+    ("Thir-ty", "30"),
+    ("Th'irty", "30"),
+    ("Song (Live)", "song"),
+    ("Song (Remastered 2011) - Bonus", "song"),
+    ("Hey (Jude) & Co", "hey"),
+    ("(Intro)", ""),
+    ("A & B (feat. C & D)", "aandb"),
+    ("Rock'n'Roll (Thirty Mix)", "rocknroll"),
+    ("Don't-Stop?! (Live, 1979)", "dontstop"),
+    ("Thirty(Thirty)", "30"),
+    ("é(á)", "e"),
+]
+
+golden_tracks = [
+    (("Queen", "A Night at the Opera", "01 Death on Two Legs (Dedicated to...)"),
+     "queenanightattheoperadeathontwolegs"),
+    (("AC/DC", "Back in Black", "10-Rock and Roll Ain't Noise Pollution"),
+     "ac/dcbackinblackandrollaintnoisepollution"),
+]
+
+class TestMatchKeys(unittest.TestCase):
+    def test_strstd(self):
+        for s, key in golden:
+            with self.subTest(s=s):
+                self.assertEqual(strstd(s), key)
+
+    def test_track_key(self):
+        for (artist, album, title), key in golden_tracks:
+            with self.subTest(title=title):
+                self.assertEqual(Track(artist, album, title).key, key)
+
+
+class TestIncremental(unittest.TestCase):
+    header = "Artist;Album;Track;Date\n"
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.csv_path = f"{self.tmpdir}/export.csv"
+        self.mark_path = f"{self.tmpdir}/lastfm_import.json"
+        self.tracks = list(catalog(20))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def row(self, i, date):
+        t = self.tracks[i]
+        return f"{t['ARTIST']};{t['ALBUM']};{t['TITLE']};{date}\n"
+
+    def write(self, rows):
+        with open(self.csv_path, "w") as f:
+            f.write(self.header + "".join(rows))
+
+    def mark(self, rows, commit=1):
+        self.write(rows)
+        LastFM(self.csv_path, cache=False).save_mark(self.mark_path, commit)
+        return LastFM.load_mark(self.mark_path, commit)
+
+    def span_text(self, span):
+        with open(self.csv_path, "rb") as f:
+            f.seek(span[0])
+            return f.read(span[1] - span[0]).decode()
+
+    def test_export_rows(self):
+        rows = [self.row(i, f"0{i} Jan 2020 10:00") for i in range(5)]
+        self.write(rows)
+        total, found = export_rows(self.csv_path, (0, 2, -1, 7))
+        self.assertEqual(total, 5)
+        self.assertEqual(sorted(found), [0, 2, 4])
+        self.assertEqual(found[2][0], len(self.header) + len(rows[0]) + len(rows[1]))
+        self.assertEqual(found[4][1].decode(), rows[4])
+
+    def test_grown_at_bottom(self):
+        old = [self.row(i, f"0{i} Jan 2020 10:00") for i in range(3)]
+        new = [self.row(i, f"0{i} Feb 2020 10:00") for i in range(4)]
+        mark = self.mark(old)
+        self.write(old + new)
+        span, newest_first = LastFM.new_rows(self.csv_path, mark)
+        self.assertFalse(newest_first)
+        self.assertEqual(self.span_text(span), "".join(new))
+
+    def test_grown_at_top(self):
+        old = [self.row(i, f"0{i} Jan 2020 10:00") for i in reversed(range(3))]
+        new = [self.row(i, f"0{i} Feb 2020 10:00") for i in reversed(range(4))]
+        mark = self.mark(old)
+        self.write(new + old)
+        span, newest_first = LastFM.new_rows(self.csv_path, mark)
+        self.assertTrue(newest_first)
+        self.assertEqual(self.span_text(span), "".join(new))
+
+    def test_nothing_new(self):
+        old = [self.row(i, f"0{i} Jan 2020 10:00") for i in range(3)]
+        mark = self.mark(old)
+        span, newest_first = LastFM.new_rows(self.csv_path, mark)
+        self.assertEqual(span[0], span[1])
+        self.assertEqual(span[1], os.path.getsize(self.csv_path))
+
+    def test_replaced_export(self):
+        mark = self.mark([self.row(i, f"0{i} Jan 2020 10:00") for i in range(3)])
+        self.write([self.row(i, f"0{i} Mar 2020 10:00") for i in range(5)])
+        self.assertIsNone(LastFM.new_rows(self.csv_path, mark))
+        self.write([self.row(0, "01 Jan 2020 10:00")])
+        self.assertIsNone(LastFM.new_rows(self.csv_path, mark))
+
+    def test_header_only_export(self):
+        mark = self.mark([])
+        self.assertEqual(mark["rows"], 0)
+        self.write([self.row(0, "01 Jan 2020 10:00")])
+        self.assertIsNone(LastFM.new_rows(self.csv_path, mark))
+
+        mark = self.mark([self.row(0, "01 Jan 2020 10:00")])
+        self.write([])
+        self.assertIsNone(LastFM.new_rows(self.csv_path, mark))
+
+    def test_other_database_commit(self):
+        self.mark([self.row(0, "01 Jan 2020 10:00")], commit=7)
+        self.assertIsNotNone(LastFM.load_mark(self.mark_path, 7))
+        self.assertIsNone(LastFM.load_mark(self.mark_path, 8))
+        self.assertIsNone(LastFM.load_mark(f"{self.tmpdir}/missing.json", 7))
+
+    def test_lastplayed_follows_latest_play(self):
+        # B was imported before, then A, B, A were played: A has to end up
+        # with the higher LASTPLAYED whichever way the export is listed
+        a, b = 0, 1
+        old = [self.row(b, "01 Jan 2020 10:00")]
+        new = [self.row(a, "02 Jan 2020 10:00"), self.row(b, "03 Jan 2020 10:00"),
+               self.row(a, "04 Jan 2020 10:00")]
+
+        for newest_first in (False, True):
+            with self.subTest(newest_first=newest_first):
+                dbdir = f"{self.tmpdir}/db"
+                shutil.rmtree(dbdir, ignore_errors=True)
+                generate_rbdb(dbdir, len(self.tracks), played=0)
+                for rows in (old, new[::-1] + old if newest_first else old + new):
+                    self.write(rows)
+                    subprocess.run([sys.executable, "rbdbutil.py", "--dbdir", dbdir, "--lastfm", self.csv_path,
+                                    "--import-counts", "--incremental"],
+                                   check=True, capture_output=True,
+                                   cwd=os.path.dirname(os.path.abspath(__file__)))
+
+                rbdb = RBDB(dbdir)
+                field = lambda i, name: rbdb.get_numeric_field(24 + i * RBDB.ENTRY_LEN, name)
+                self.assertEqual((field(a, "PLAYCOUNT"), field(b, "PLAYCOUNT")), (2, 2))
+                self.assertGreater(field(a, "LASTPLAYED"), field(b, "LASTPLAYED"))
+
+
+if __name__ == '__main__':
+    unittest.main()